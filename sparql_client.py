@@ -0,0 +1,245 @@
+"""
+    sparql_client.py -- SPARQL query client for the VIVO Data Project tools.
+    Keeps HTTP connections to VIVO open between queries, runs independent
+    queries concurrently, coalesces identical queries and limits the number
+    of simultaneous requests made to each endpoint.
+
+    Version 0.1 MC 2014-08-12
+    --  Initial version.
+
+    Example:
+
+    client = SparqlClient()
+    client.query_many([query1, query2, query3])   # run concurrently
+    result = client.query(query2)                  # already answered
+"""
+
+__author__ = "Michael Conlon"
+__copyright__ = "Copyright 2013, University of Florida"
+__license__ = "BSD 3-Clause license"
+__version__ = "0.1"
+
+import httplib
+import json
+import socket
+import threading
+import urllib
+import urlparse
+
+DEFAULT_ENDPOINT = "http://sparql.vivo.ufl.edu/VIVO/sparql"
+
+PREFIXES = """
+PREFIX rdf:    <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+PREFIX rdfs:   <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX xsd:    <http://www.w3.org/2001/XMLSchema#>
+PREFIX owl:    <http://www.w3.org/2002/07/owl#>
+PREFIX foaf:   <http://xmlns.com/foaf/0.1/>
+PREFIX skos:   <http://www.w3.org/2004/02/skos/core#>
+PREFIX bibo:   <http://purl.org/ontology/bibo/>
+PREFIX vivo:   <http://vivoweb.org/ontology/core#>
+PREFIX ufVivo: <http://vivo.ufl.edu/ontology/vivo-ufl/>
+"""
+
+
+class EndpointPool(object):
+    """
+    Idle keep-alive connections to a single SPARQL endpoint, and a
+    semaphore limiting the number of requests in progress against it.
+    """
+    def __init__(self, endpoint, max_connections, timeout):
+        parts = urlparse.urlsplit(endpoint)
+        if parts.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.netloc = parts.netloc
+        self.path = parts.path or '/'
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.limit = threading.BoundedSemaphore(max_connections)
+
+    def get_connection(self):
+        """
+        Return an idle connection if there is one, otherwise a new one, and
+        whether the connection was idle
+        """
+        with self.lock:
+            if self.idle:
+                return [self.idle.pop(), True]
+        return [self.new_connection(), False]
+
+    def new_connection(self):
+        """
+        Return a new connection to the endpoint
+        """
+        return self.connection_class(self.netloc, timeout=self.timeout)
+
+    def put_connection(self, conn):
+        """
+        Return a connection to the pool for reuse
+        """
+        with self.lock:
+            self.idle.append(conn)
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+    def fetch(self, query):
+        """
+        Send a query over a pooled connection and return the response body.
+        A keep-alive connection may have been closed by the server while
+        idle, so a request that fails on an idle connection is retried once
+        on a new connection.  The server closes idle connections together,
+        so the other idle connections are closed as well.  Timeouts and
+        failures on new connections are not retried.
+        """
+        url = self.path + "?" + urllib.urlencode({'query': PREFIXES + query})
+        headers = {'Accept': 'application/sparql-results+json',
+                   'Connection': 'keep-alive'}
+        self.limit.acquire()
+        try:
+            [conn, idle] = self.get_connection()
+            while True:
+                try:
+                    conn.request('GET', url, headers=headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                except socket.timeout:
+                    conn.close()
+                    raise
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    if not idle:
+                        raise
+                    self.close()
+                    [conn, idle] = [self.new_connection(), False]
+                    continue
+                if response.status != 200:
+                    conn.close()
+                    raise httplib.HTTPException("SPARQL query failed: " +
+                        str(response.status) + " " + response.reason)
+                if response.getheader('connection', '').lower() == 'close':
+                    conn.close()
+                else:
+                    self.put_connection(conn)
+                return body
+        finally:
+            self.limit.release()
+
+
+class SparqlClient(object):
+    """
+    Query VIVO over persistent connections.  Results are kept by query
+    text, so a query already answered, or in flight on another thread, is
+    not sent again.
+    """
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, max_connections=4,
+                 timeout=60):
+        self.endpoint = endpoint
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.pools = {}
+        self.results = {}
+        self.in_flight = {}
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def get_pool(self, endpoint):
+        """
+        Return the connection pool for an endpoint, creating it if needed
+        """
+        with self.lock:
+            pool = self.pools.get(endpoint, None)
+            if pool is None:
+                pool = EndpointPool(endpoint, self.max_connections,
+                                    self.timeout)
+                self.pools[endpoint] = pool
+            return pool
+
+    def query(self, query, endpoint=None):
+        """
+        Given a SPARQL query, return the parsed JSON result.  If the same
+        query is already running on another thread, wait for its result
+        rather than sending it again, and raise its error if it fails.  A
+        query that failed in query_many raises its error here once, rather
+        than being sent again.
+        """
+        if endpoint is None:
+            endpoint = self.endpoint
+        key = (endpoint, query)
+        while True:
+            with self.lock:
+                if key in self.results:
+                    return self.results[key]
+                if key in self.failures:
+                    raise self.failures.pop(key)
+                pending = self.in_flight.get(key, None)
+                if pending is None:
+                    pending = [threading.Event(), None]
+                    self.in_flight[key] = pending
+                    break
+            pending[0].wait()
+            if pending[1] is not None:
+                raise pending[1]
+        try:
+            result = json.loads(self.get_pool(endpoint).fetch(query))
+            with self.lock:
+                self.results[key] = result
+            return result
+        except Exception as error:
+            pending[1] = error
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            pending[0].set()
+
+    def query_many(self, queries, endpoint=None):
+        """
+        Run a list of independent queries concurrently, waiting for all of
+        them to finish.  Results are available through query().  The error
+        of a query that fails here is raised by the next query() for it.
+        """
+        if endpoint is None:
+            endpoint = self.endpoint
+        def run(query):
+            try:
+                self.query(query, endpoint)
+            except Exception as error:
+                with self.lock:
+                    self.failures[(endpoint, query)] = error
+        threads = []
+        for query in set(queries):
+            thread = threading.Thread(target=run, args=(query,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def load_results(self, results, endpoint=None):
+        """
+        Add queries answered in an earlier run, given as a list of
+        [query, result]
+        """
+        if endpoint is None:
+            endpoint = self.endpoint
+        with self.lock:
+            for query, result in results:
+                self.results[(endpoint, query)] = result
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            pools = self.pools.values()
+        for pool in pools:
+            pool.close()
@@ -9,6 +9,12 @@
         done.
     Version 0.3 MC 2014-08-09
     -- Geo Foci added
+    Version 0.4 MC 2014-08-12
+    -- SPARQL queries go through sparql_client, which keeps connections to
+       VIVO open and runs the independent lookups for a row concurrently
+    Version 0.5 MC 2014-08-14
+    -- Checkpoints every CHECKPOINT_ROWS rows.  --resume continues a run
+       from its last checkpoint
 
     To Do:
     Awards and Patents.
@@ -22,18 +28,31 @@ __version__ = "0.1"
 
 from vivotools import read_csv
 from datetime import datetime
-from vivotools import get_vivo_value
-from vivotools import get_vivo_uri
 from vivotools import update_data_property
 from vivotools import assert_resource_property
 from vivotools import rdf_header
 from vivotools import rdf_footer
-from vivotools import vivo_sparql_query
+from sparql_client import SparqlClient
 
 import sys
 import json
 import codecs
 import os
+import random
+import vivotools
+
+vivo_client = SparqlClient()
+
+CHECKPOINT_ROWS = 25
+
+# Label lookups (organizations, concepts, journals) are shared between
+# people, so they are saved with each checkpoint.  Lookups of a person
+# are not used again and are not saved
+
+saved_lookups = set()
+new_lookups = []
+
+VIVO_URI_PREFIX = "http://vivo.ufl.edu/individual/n"
 
 # Helper functions
 
@@ -60,16 +79,10 @@ def make_datetime(y, m, d):
         dt = None
     return dt
 
-def find_entity_uri(entity_type, entity_predicate, entity_value, debug=False):
+def make_entity_query(entity_type, entity_predicate, entity_value):
     """
-    Given a type and a predicate and its value, find the uri of the first
-    entity of that type, with that predicate.
-
-    Example:
-
-    find_entity_uri('skos:Concept', 'rdfs:label', 'Pulmonary Hypertension')
-
-    if not found, return None
+    Given a type and a predicate and its value, return the SPARQL query
+    used by find_entity_uri
     """
     query = """
         SELECT ?uri
@@ -84,7 +97,24 @@ def find_entity_uri(entity_type, entity_predicate, entity_value, debug=False):
     query = query.replace('{{entity_type}}', entity_type)
     query = query.replace('{{entity_predicate}}', entity_predicate)
     query = query.replace('{{entity_value}}', entity_value)
-    result = vivo_sparql_query(query)
+    return query
+
+def find_entity_uri(entity_type, entity_predicate, entity_value, debug=False):
+    """
+    Given a type and a predicate and its value, find the uri of the first
+    entity of that type, with that predicate.
+
+    Example:
+
+    find_entity_uri('skos:Concept', 'rdfs:label', 'Pulmonary Hypertension')
+
+    if not found, return None
+    """
+    query = make_entity_query(entity_type, entity_predicate, entity_value)
+    result = vivo_client.query(query)
+    if entity_predicate == 'rdfs:label' and query not in saved_lookups:
+        saved_lookups.add(query)
+        new_lookups.append([query, result])
     if debug:
         print query
         print result
@@ -95,6 +125,104 @@ def find_entity_uri(entity_type, entity_predicate, entity_value, debug=False):
     except:
         return None
 
+def make_value_query(uri, predicate):
+    """
+    Given a uri and a predicate, return the SPARQL query used by
+    get_vivo_value
+    """
+    query = """
+        SELECT ?value
+        WHERE {
+            <{{uri}}> {{predicate}} ?value .
+        }
+        LIMIT 1
+        """
+    query = query.replace('{{uri}}', uri)
+    query = query.replace('{{predicate}}', predicate)
+    return query
+
+def get_vivo_value(uri, predicate):
+    """
+    Given a uri and a predicate, return the first value of the predicate
+    for the uri in VIVO.
+
+    Example:
+
+    get_vivo_value('http://vivo.ufl.edu/individual/n25562', 'foaf:lastName')
+
+    if not found, return None
+    """
+    result = vivo_client.query(make_value_query(uri, predicate))
+    try:
+        b = result["results"]["bindings"][0]
+        value = b['value']['value']
+        return value
+    except:
+        return None
+
+def get_vivo_uri():
+    """
+    Return a new VIVO uri, one not in VIVO and not already returned in
+    this run
+    """
+    while True:
+        uri = VIVO_URI_PREFIX + str(random.randint(1, 2**31))
+        if uri in vivo_uris:
+            continue
+        result = vivo_client.query("ASK { <" + uri + "> ?p ?o }")
+        if not result['boolean']:
+            vivo_uris.add(uri)
+            return uri
+
+vivo_uris = set()
+
+# vivotools functions such as add_dti call vivotools.get_vivo_uri, which
+# opens a new connection to VIVO for each uri.  Have them use this one
+
+vivotools.get_vivo_uri = get_vivo_uri
+
+def row_lookups(row):
+    """
+    Given a survey row for a person whose last name matches, return the
+    VIVO lookups the rest of the row needs, keyed by survey field.  values
+    holds the predicates to look up for the person with get_vivo_value,
+    entities the arguments of find_entity_uri.  The main loop processes a
+    part of the row only when its key is here.
+    """
+    values = {}
+    entities = {}
+    if row['era_commons_id'] != "":
+        values['era_commons_id'] = 'vivo:eRACommonsId'
+    if row['expert_1_overv'] != '':
+        values['expert_1_overv'] = 'vivo:researchOverview'
+    for i in range(1,5):
+        key = 'deg_'+str(i)
+        if row['degree_choice_'+str(i)] != "":
+            entities[key] = ['foaf:Organization', 'rdfs:label',
+                             row[key+'_place']]
+    for i in range(1,3):
+        key = 'expert_' + str(i)
+        if row[key] != "":
+            entities[key] = ['skos:Concept', 'rdfs:label', row[key]]
+    for i in range(1,10):
+        key = 'roles_'+str(i)
+        if row[key+'_yn'] != "1" and row[key+'_yn'] != "":
+            entities[key] = ['bibo:Journal', 'rdfs:label',
+                             row[key+'_journal']]
+    return [values, entities]
+
+def lookup_queries(uri, values, entities):
+    """
+    Given the uri of a person and the lookups from row_lookups, return
+    their SPARQL queries.  They do not depend on each other, so they can
+    be run together before the row is processed.
+    """
+    queries = [make_value_query(uri, predicate)
+               for predicate in values.values()]
+    queries = queries + [make_entity_query(*entity)
+                         for entity in entities.values()]
+    return queries
+
 def add_award(award):
     """
     Given an award structure, generate a uri and RDF to add the award to VIVO
@@ -540,13 +668,116 @@ def add_service(service):
                                            dti_uri)
     return [ardf, uri]
 
+def write_file(name, text):
+    """
+    Write text to a file, replacing any earlier file of that name only
+    once the new one is complete
+    """
+    temp_file = codecs.open(name+".tmp", mode='w', encoding='utf-8')
+    temp_file.write(text)
+    temp_file.close()
+    os.rename(name+".tmp", name)
+
+def append_file(name, text):
+    """
+    Append text to a file and return the length of the file in bytes
+    """
+    out_file = codecs.open(name, mode='a', encoding='utf-8')
+    out_file.write(text)
+    out_file.close()
+    return os.path.getsize(name)
+
+def truncate_file(name, length):
+    """
+    Cut a file back to its first length bytes
+    """
+    out_file = open(name, 'a')
+    out_file.truncate(length)
+    out_file.close()
+
+def new_checkpoint():
+    """
+    Return the checkpoint of a run that has not completed any rows
+    """
+    checkpoint = {
+        'row_number': None,
+        'record_id': None,
+        'add_chars': 0,
+        'sub_chars': 0,
+        'add_length': 0,
+        'sub_length': 0,
+        'exc_length': 0,
+        'lookups_length': 0,
+        'timestamp': None
+        }
+    return checkpoint
+
+def write_checkpoint(file_name, checkpoint, row_number, record_id, ardf, srdf,
+                     exc_file_name):
+    """
+    Append the add and sub rdf and the label lookups made since the last
+    checkpoint to the partial files, then save the length of each file, and
+    of the exception file, and the last completed row, so that a run can be
+    continued with --resume.  The exception file must be flushed first.
+    """
+    checkpoint['add_length'] = append_file(file_name+"_add_partial.rdf",
+        ardf[checkpoint['add_chars']:])
+    checkpoint['add_chars'] = len(ardf)
+    checkpoint['sub_length'] = append_file(file_name+"_sub_partial.rdf",
+        srdf[checkpoint['sub_chars']:])
+    checkpoint['sub_chars'] = len(srdf)
+    lines = [json.dumps(lookup) + "\n" for lookup in new_lookups]
+    checkpoint['lookups_length'] = append_file(file_name+"_lookups.txt",
+        "".join(lines))
+    del new_lookups[:]
+    checkpoint['exc_length'] = os.path.getsize(exc_file_name)
+    checkpoint['row_number'] = row_number
+    checkpoint['record_id'] = record_id
+    checkpoint['timestamp'] = str(datetime.now())
+    write_file(file_name+"_checkpoint.json", json.dumps(checkpoint))
+
+def read_checkpoint(file_name):
+    """
+    Return the checkpoint saved by write_checkpoint with the partial add
+    and sub rdf, and load its lookups into the query client.  Return
+    [None, None, None] if there is no checkpoint.
+    """
+    if not os.path.exists(file_name+"_checkpoint.json"):
+        return [None, None, None]
+    checkpoint = json.load(open(file_name+"_checkpoint.json"))
+
+    # A later checkpoint that did not finish may have appended to the
+    # partial files.  Cut them back to their length at this checkpoint
+
+    truncate_file(file_name+"_add_partial.rdf", checkpoint['add_length'])
+    truncate_file(file_name+"_sub_partial.rdf", checkpoint['sub_length'])
+    truncate_file(file_name+"_lookups.txt", checkpoint['lookups_length'])
+    ardf = codecs.open(file_name+"_add_partial.rdf", encoding='utf-8').read()
+    srdf = codecs.open(file_name+"_sub_partial.rdf", encoding='utf-8').read()
+    lookups = [json.loads(line) for line in open(file_name+"_lookups.txt")]
+    vivo_client.load_results(lookups)
+    for query, result in lookups:
+        saved_lookups.add(query)
+    return [checkpoint, ardf, srdf]
+
+def remove_checkpoint(file_name):
+    """
+    Remove the checkpoint files of a finished run
+    """
+    for name in ["_checkpoint.json", "_add_partial.rdf", "_sub_partial.rdf",
+                 "_lookups.txt"]:
+        if os.path.exists(file_name+name):
+            os.remove(file_name+name)
+
 
 # Start here
 
 print datetime.now(),"Start"
 
-if len(sys.argv) > 1:
-    input_file_name = str(sys.argv[1])
+resume = '--resume' in sys.argv
+args = [arg for arg in sys.argv[1:] if arg != '--resume']
+if len(args) > 0:
+    input_file_name = str(args[0])
 else:
     input_file_name = "VIVODataCollectionTo_DATA_2014-07-29_0909.csv"
 file_name, file_extension = os.path.splitext(input_file_name)
@@ -567,11 +798,55 @@ for row_number,row in geo_codes.items():
 redcap = read_csv(input_file_name)
 print datetime.now(), len(redcap), "records in survey file", input_file_name
 
-exc_file = open("exc_file.txt", "w")
-ardf = rdf_header()
-srdf = rdf_header()
+exc_file_name = "exc_file.txt"
+checkpoint = None
+if resume:
+    [checkpoint, ardf, srdf] = read_checkpoint(file_name)
+    if checkpoint is None:
+        print datetime.now(), "No checkpoint found for", input_file_name, \
+            "starting from the first record"
+    elif checkpoint['row_number'] not in redcap or \
+        redcap[checkpoint['row_number']]['record_id'] != \
+        checkpoint['record_id']:
+        print datetime.now(), "Checkpoint after record_id", \
+            checkpoint['record_id'], "does not match survey file", \
+            input_file_name
+        sys.exit(1)
+if checkpoint is None:
+    remove_checkpoint(file_name)
+    checkpoint = new_checkpoint()
+    exc_file = open(exc_file_name, "w")
+    ardf = rdf_header()
+    srdf = rdf_header()
+    resume_after = None
+else:
+
+    # Drop exceptions written for rows after the checkpoint, which will be
+    # processed again
 
+    truncate_file(exc_file_name, checkpoint['exc_length'])
+    exc_file = open(exc_file_name, "a")
+    resume_after = checkpoint['row_number']
+    print datetime.now(), "Resuming after record_id", \
+        checkpoint['record_id'], "from checkpoint of", checkpoint['timestamp']
+
+rows_done = 0
+last_row_number = None
 for row_number in sorted(redcap.keys()):
+    if resume_after is not None and row_number <= resume_after:
+        continue
+
+    # Every row before this one is complete
+
+    if rows_done > 0 and rows_done % CHECKPOINT_ROWS == 0:
+        exc_file.flush()
+        write_checkpoint(file_name, checkpoint, last_row_number,
+            redcap[last_row_number]['record_id'], ardf, srdf, exc_file_name)
+        print datetime.now(), "Checkpoint after record_id", \
+            redcap[last_row_number]['record_id']
+    rows_done = rows_done + 1
+    last_row_number = row_number
+
     row = redcap[row_number]
     print json.dumps(row, indent=4)
 
@@ -590,11 +865,16 @@ for row_number in sorted(redcap.keys()):
             "lastname = ", row['last_name']
         continue
 
+    # Run the lookups for the rest of the row together
+
+    [values, entities] = row_lookups(row)
+    vivo_client.query_many(lookup_queries(uri, values, entities))
+
     # eRACommonsId
 
-    if row['era_commons_id'] != "":
-        vivo_era_commons = get_vivo_value(uri, 'vivo:eRACommonsId')
-        [add, sub] = update_data_property(uri, 'vivo:eRACommonsId', \
+    if 'era_commons_id' in values:
+        vivo_era_commons = get_vivo_value(uri, values['era_commons_id'])
+        [add, sub] = update_data_property(uri, values['era_commons_id'], \
             vivo_era_commons, row['era_commons_id'])
         ardf = ardf + add
         srdf = srdf + sub
@@ -617,9 +897,8 @@ for row_number in sorted(redcap.keys()):
     for i in range(1,5):
         degree = {}
         key = 'deg_'+str(i)
-        if row['degree_choice_'+str(i)] != "":
-            degree['org_uri'] = find_entity_uri('foaf:Organization',
-                'rdfs:label', row[key+'_place'], debug=True)
+        if key in entities:
+            degree['org_uri'] = find_entity_uri(*entities[key], debug=True)
             degree['date'] = make_datetime(row[key+'_date_y'],\
                 row[key+'_date_m'], row[key+'_date_d'])
             degree['field'] = row[key+'_field']
@@ -630,9 +909,9 @@ for row_number in sorted(redcap.keys()):
 
     # Research Overview
 
-    if row['expert_1_overv'] != '':
-        vivo_value = get_vivo_value(uri, 'vivo:researchOverview')
-        [add, sub] = update_data_property(uri, 'vivo:researchOverview',\
+    if 'expert_1_overv' in values:
+        vivo_value = get_vivo_value(uri, values['expert_1_overv'])
+        [add, sub] = update_data_property(uri, values['expert_1_overv'],\
             vivo_value, row['expert_1_overv'])
         ardf = ardf + add
         srdf = srdf + sub
@@ -641,9 +920,8 @@ for row_number in sorted(redcap.keys()):
 
     for i in range(1,3):
         key = 'expert_' + str(i)
-        if row[key] != "":
-            concept_uri = find_entity_uri('skos:Concept', 'rdfs:label', \
-                                          row[key])
+        if key in entities:
+            concept_uri = find_entity_uri(*entities[key])
             if concept_uri is not None:
                 ardf = ardf + assert_resource_property(uri,
                     'vivo:hasSubjectArea', concept_uri)
@@ -673,9 +951,8 @@ for row_number in sorted(redcap.keys()):
     for i in range(1,10):
         service = {}
         key = 'roles_'+str(i)
-        if row[key+'_yn'] != "1" and row[key+'_yn'] != "":
-            service['org_uri'] = find_entity_uri('bibo:Journal', 'rdfs:label', \
-                                               row[key+'_journal'], debug=True)
+        if key in entities:
+            service['org_uri'] = find_entity_uri(*entities[key], debug=True)
             service['start_date'] = make_datetime(row[key+'_start_y'],
                 row[key+'_start_m'], row[key+'_start_d'])
             service['end_date'] = make_datetime(row[key+'_start_y'],
@@ -692,5 +969,7 @@ sub_file.write(srdf)
 add_file.close()
 sub_file.close()
 exc_file.close()
+vivo_client.close()
+remove_checkpoint(file_name)
 
 print datetime.now(),"Finished"